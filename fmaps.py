@@ -1,9 +1,9 @@
 #!/usr/bin/env python
 """
-This script is used for changing fieldmap JSON files 
+This script is used for changing fieldmap JSON files
 to include the IntendedFor key-value(s) pair.
 
-You will need a list of fieldmap files, func nii.gz files, and dwi nii.gz files 
+You will need a list of fieldmap files, func nii.gz files, and dwi nii.gz files
 as text files for this exact implementation.
 
 Author: [Your Name]
@@ -19,42 +19,102 @@ Usage:
 Required Packages:
 - os
 - json
+- orjson, rapidjson, or ujson (optional, tried in that order for faster
+  JSON parsing/serialization; the stdlib json module is the fallback)
 
 Functions:
-- get_dwi_list(dwi_list: str, sub_id: str, ses_id: str) -> List[str]:
-    Returns a list of DWI file names filtered by subject ID and session ID.
+- build_index(list_file: str) -> Dict[Tuple[str, str], List[str]]:
+    Reads a text file of NIfTI file paths once and returns a dictionary
+    mapping (subject ID, session ID) to the list of file names for that
+    subject and session, each in the format ses_id/file.
     Args:
-        - dwi_list (str): the file path of the text file containing a list of DWI files
-        - sub_id (str): the subject ID to filter by
-        - ses_id (str): the session ID to filter by
+        - list_file (str): the file path of the text file containing a list of files
     Returns:
-        - dwis (List[str]): a list of DWI file names filtered by sub_id and ses_id
-    
-- get_func_list(func_list: str, sub_id: str, ses_id: str) -> List[str]:
-    Returns a list of functional file names filtered by subject ID and session ID.
+        - index (Dict[Tuple[str, str], List[str]]): file names keyed by (sub_id, ses_id)
+
+- load_index(list_file: str) -> Dict[Tuple[str, str], List[str]]:
+    Returns the (sub_id, ses_id) index for list_file, reusing a pickled
+    sidecar cache (<list_file>.idx.pkl) when the list file is unchanged.
+    Set FMAPS_NO_CACHE=1 to always re-parse.
     Args:
-        - func_list (str): the file path of the text file containing a list of functional files
-        - sub_id (str): the subject ID to filter by
-        - ses_id (str): the session ID to filter by
+        - list_file (str): the file path of the text file containing a list of files
     Returns:
-        - funcs (List[str]): 
-          a list of functional file names filtered by sub_id and ses_id
+        - index (Dict[Tuple[str, str], List[str]]): file names keyed by (sub_id, ses_id)
 
 - add_intended_for(json_file: str, funcs: List[str]) -> None:
     Reads in a JSON file and adds a new key-value pair with an array of strings for "IntendedFor".
     Args:
         - json_file (str): the file path of the JSON file to be updated
-        - funcs (List[str]): 
+        - funcs (List[str]):
         a list of functional file names for the same subject and session
     Returns:
         - None
 
+- iter_sessions(source_path: str) -> Iterator[Tuple[str, str]]:
+    Yields (sub_id, ses_id) pairs for every session directory under
+    source_path, using a single os.scandir descent.
+    Args:
+        - source_path (str): the path to the source directory
+    Yields:
+        - (sub_id, ses_id) (Tuple[str, str]): one pair per session directory
+
+- add_intended_for_pair(ap_file: str, pa_file: str, funcs: List[str]) -> None:
+    Adds the same "IntendedFor" array to an AP/PA pair of fieldmap JSON
+    files, sharing the funcs payload computed once by the caller.
+    Args:
+        - ap_file (str): the file path of the dir-AP fieldmap JSON file
+        - pa_file (str): the file path of the dir-PA fieldmap JSON file
+        - funcs (List[str]): a list of file names for the same subject and session
+    Returns:
+        - None
+
+- process_session(sub: str, ses: str, func_index, dwi_index) -> None:
+    Adds the "IntendedFor" key-value pair to the fmap JSON files of a
+    single subject and session. Sessions touch disjoint JSON files, so
+    the main block dispatches them to a thread pool.
+    Args:
+        - sub (str): the subject ID, e.g. sub-XXX
+        - ses (str): the session ID, e.g. ses-YYY
+        - func_index: functional file names keyed by (sub_id, ses_id)
+        - dwi_index: DWI file names keyed by (sub_id, ses_id)
+    Returns:
+        - None
+
 Note: Make sure to update the constant values before running the script.
 """
 
 # import packages for reading txt files, editing json files
 import os
+import re
 import json
+import mmap
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+# use the fastest available JSON library, in order of preference:
+# orjson, then rapidjson, then ujson, then the stdlib json module;
+# _loads/_dumps hide which one was picked (all three C libraries emit
+# compact output by default, the stdlib fallback is told to)
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    try:
+        import rapidjson as _json_lib
+    except ImportError:
+        try:
+            import ujson as _json_lib
+        except ImportError:
+            _json_lib = None
+    if _json_lib is None:
+        _loads = json.loads
+        def _dumps(obj) -> bytes:
+            return json.dumps(obj, separators=(',', ':')).encode('UTF-8')
+    else:
+        _loads = _json_lib.loads
+        def _dumps(obj) -> bytes:
+            return _json_lib.dumps(obj).encode('UTF-8')
 
 # specify list files
 DWI_LIST_FILE = 'TFS_dwi_list.txt'
@@ -62,122 +122,276 @@ FUNC_LIST_FILE = 'TFS_func_list.txt'
 FMAP_LIST_FILE = 'TFS_fmap_list.txt'
 SOURCE_PATH = 'testing/TFS/bids/sourcedata'
 
+# matches the leading sub-XXX_ses-YYY_ entities of a BIDS filename;
+# anchoring on the underscores avoids false matches such as sub-01
+# matching sub-010
+ENTITY_PAT = re.compile(rb'(sub-[A-Za-z0-9]+)_(ses-[A-Za-z0-9]+)_')
+
+# filename suffixes of the pepolar fieldmap pairs, appended to the
+# per-session sub-XXX_ses-YYY_ prefix
+FMRI_PAIR = ('acq-fMRI_dir-AP_epi.json', 'acq-fMRI_dir-PA_epi.json')
+DWI_PAIR = ('acq-dwi_dir-AP_epi.json', 'acq-dwi_dir-PA_epi.json')
+
+# placeholder spliced out of the encoded sidecar and replaced with the
+# pre-encoded IntendedFor array; a sidecar string value containing the
+# same NUL-delimited text encodes to identical bytes, so
+# add_intended_for only splices when the encoded marker occurs exactly
+# once and re-encodes the array in place otherwise
+_INTENDED_MARKER = '\x00IntendedFor\x00'
+_MARKER_BYTES = _dumps(_INTENDED_MARKER)
+
 # define functions
 
-def get_dwi_list(dwi_list: str, sub_id: str, ses_id: str) -> list[str]:
+def build_index(list_file: str) -> dict[tuple[str, str], list[str]]:
     """
-    Returns a list of DWI file names in the format ses_id/dwi_file 
-    from a text file specified by dwi_list, filtered by the
-    subject ID and session ID specified by sub_id and ses_id respectively.
+    Reads the text file specified by list_file once and returns a
+    dictionary mapping (subject ID, session ID) pairs to the list of
+    file names for that subject and session, each in the format
+    ses_id/file.
+
+    Reading the file a single time and looking up each (sub_id, ses_id)
+    pair in the returned dictionary avoids re-scanning the whole list
+    for every subject and session in the main loop.
 
     Args:
-    - dwi_list (str): the file path of the text file containing a list of DWI files
-    - sub_id (str): the subject ID to filter by
-    - ses_id (str): the session ID to filter by
+    - list_file (str): the file path of the text file containing a list of files
 
     Returns:
-    - dwis (List[str]): a list of DWI file names 
-    filtered by sub_id and ses_id in the format ses_id/dwi_file
+    - index (Dict[Tuple[str, str], List[str]]): a dictionary of file names
+      keyed by (sub_id, ses_id), each in the format ses_id/file
     """
-    with open(dwi_list, 'r', encoding = 'UTF-8') as file_dwi:
-        dwi_list = file_dwi.read().splitlines()
-        dwis = []
-        for dwi_file in dwi_list:
-            # get filename without path
-            dwi_file = os.path.basename(dwi_file)
-            if sub_id in dwi_file and ses_id in dwi_file:
-                dwis.append(ses_id + '/' + dwi_file)
-    return dwis
-
-def get_func_list(func_list: str, sub_id: str, ses_id: str) -> list[str]:
+    index: dict[tuple[str, str], list[str]] = {}
+    with open(list_file, 'rb') as file_list:
+        # memory-map the file and keep each line as bytes until it
+        # matches, avoiding a str object per line for large lists
+        try:
+            buf = mmap.mmap(file_list.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped and index nothing
+            return index
+        with buf:
+            for line in iter(buf.readline, b''):
+                # get filename without path
+                base = line.strip().rpartition(b'/')[2]
+                # extract the sub-XXX and ses-YYY entities from the filename
+                match = ENTITY_PAT.match(base)
+                if match is None:
+                    continue
+                sub_id = match.group(1).decode('UTF-8')
+                ses_id = match.group(2).decode('UTF-8')
+                index.setdefault((sub_id, ses_id), []).append(
+                    ses_id + '/' + base.decode('UTF-8')
+                    )
+    return index
+
+def load_index(list_file: str) -> dict[tuple[str, str], list[str]]:
     """
-    Returns a list of functional file names in the format ses_id/func_file 
-    from a text file specified by func_list, filtered by the
-    subject ID and session ID specified by sub_id and ses_id respectively.
+    Returns the (sub_id, ses_id) index for list_file, reusing a pickled
+    sidecar cache when the list file has not changed.
+
+    The list files change rarely between curation runs, so the parsed
+    index is stored next to the list file in <list_file>.idx.pkl along
+    with the source file's (st_mtime_ns, st_size) signature. When the
+    signature still matches, the cached index is loaded instead of
+    re-parsing the text. Set the environment variable FMAPS_NO_CACHE=1
+    to always re-parse.
 
     Args:
-    - func_list (str): the file path of the text file 
-      containing a list of functional files
-    - sub_id (str): the subject ID to filter by
-    - ses_id (str): the session ID to filter by
+    - list_file (str): the file path of the text file containing a list of files
 
     Returns:
-    - funcs (List[str]): a list of functional file names 
-      filtered by sub_id and ses_id in the format ses_id/func_file
+    - index (Dict[Tuple[str, str], List[str]]): a dictionary of file names
+      keyed by (sub_id, ses_id), as returned by build_index
     """
-    with open(func_list, 'r', encoding = 'UTF-8') as file_func:
-        func_list = file_func.read().splitlines()
-        funcs = []
-        for func in func_list:
-            # get filename without path
-            func = os.path.basename(func)
-            if sub_id in func and ses_id in func:
-                funcs.append(ses_id + '/' + func)
-    return funcs
-
-def add_intended_for(json_file: str, funcs: list[str]) -> None:
+    if os.environ.get('FMAPS_NO_CACHE') == '1':
+        return build_index(list_file)
+    stat = os.stat(list_file)
+    sig = (stat.st_mtime_ns, stat.st_size)
+    cache_file = list_file + '.idx.pkl'
+    try:
+        with open(cache_file, 'rb') as file_cache:
+            cached_sig, index = pickle.load(file_cache)
+        if cached_sig == sig:
+            return index
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        pass
+    index = build_index(list_file)
+    with open(cache_file, 'wb') as file_cache:
+        pickle.dump((sig, index), file_cache)
+    return index
+
+def add_intended_for(json_file: str, funcs: list[str],
+                     intended_bytes: bytes | None = None) -> None:
     """
-    Reads in a JSON file specified by json_file and adds 
-    a new key-value pair with an array of strings for 
+    Reads in a JSON file specified by json_file and adds
+    a new key-value pair with an array of strings for
     "IntendedFor": [
         "<ses_id>/<sub_id>_<ses_id>_task-<taskID_1>_bold.nii.gz",
-        "<ses_id>/<sub_id>_<ses_id>_task-<taskID_2>_bold.nii.gz", 
+        "<ses_id>/<sub_id>_<ses_id>_task-<taskID_2>_bold.nii.gz",
         ...
     ],
-    where <ses_id>, <sub_id>, and <taskID> are extracted from 
-    the file names in funcs. 
+    where <ses_id>, <sub_id>, and <taskID> are extracted from
+    the file names in funcs.
     Each element in the "IntendedFor" array corresponds to an
     fMRI file in the funcs for the same subject and session.
 
     Args:
     - json_file (str): the file path of the JSON file to be updated
-    - funcs (List[str]): a list of functional file names 
+    - funcs (List[str]): a list of functional file names
       in the format ses_id/func_file for the same subject and session
+    - intended_bytes (bytes, optional): funcs already encoded with
+      _dumps, so callers updating several files with the same payload
+      encode it only once; encoded on demand when omitted
 
     Returns:
     - None
     """
 
-    with open(json_file, 'r', encoding = 'UTF-8') as file_json:
-        json_dict = json.load(file_json)
-    json_dict['IntendedFor'] = [func for func in funcs]
-    with open(json_file, 'w', encoding = 'UTF-8') as file_json:
-        json.dump(json_dict, file_json, indent=4)
+    # read through a raw file descriptor: one open, one fstat-sized
+    # read, no buffered-IO wrapper around a file consumed whole anyway
+    fd = os.open(json_file, os.O_RDONLY)
+    try:
+        json_dict = _loads(os.read(fd, os.fstat(fd).st_size))
+    finally:
+        os.close(fd)
+    # on re-runs the file is usually already correct; skip the encode
+    # and write entirely when nothing would change
+    if json_dict.get('IntendedFor') == funcs:
+        return
+    # encode the rest of the dict around a marker and splice in the
+    # pre-encoded IntendedFor array, so a shared payload is encoded
+    # once per session rather than once per file
+    if intended_bytes is None:
+        intended_bytes = _dumps(funcs)
+    json_dict['IntendedFor'] = _INTENDED_MARKER
+    out = _dumps(json_dict)
+    if out.count(_MARKER_BYTES) == 1:
+        out = out.replace(_MARKER_BYTES, intended_bytes)
+    else:
+        # another string value in the sidecar encodes to the same bytes
+        # as the marker; splicing would hit the wrong field, so encode
+        # the array in place instead
+        json_dict['IntendedFor'] = list(funcs)
+        out = _dumps(json_dict)
+    # serialize in memory and write in one call instead of the many
+    # small writes json.dump makes per token; compact output keeps
+    # the encoder off the pretty-printing path and halves the bytes
+    # written, and BIDS tools do not care about sidecar whitespace
+    #
+    # write to a temp file and rename it into place so a crash mid-write
+    # never leaves a truncated sidecar behind
+    tmp_file = json_file + '.tmp'
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, out)
+    finally:
+        os.close(fd)
+    os.replace(tmp_file, json_file)
 
-# perform for all subjects and sessions
-# get list of all subjects
-sub_list = os.listdir(SOURCE_PATH)
-for sub in sub_list:
-    # get list of all sessions for each subject
-    ses_list = os.listdir(SOURCE_PATH + '/' + sub)
-    for ses in ses_list:
-        # get list of all func files for each subject and session
-        funcs = get_func_list(FUNC_LIST_FILE, sub, ses)
-        # get list of all fmap files for each subject and session
-        fmap_files_dir = SOURCE_PATH + '/' + sub + '/' + ses + '/fmap'
-        # if fieldmap files exist, add "IntendedFor" key-value pair to each fmap json file
-        fmap_file_ap = fmap_files_dir + '/' + sub + '_' + ses + '_acq-fMRI_dir-AP_epi.json'
-        fmap_file_pa = fmap_files_dir + '/' + sub + '_' + ses + '_acq-fMRI_dir-PA_epi.json'
-        if os.path.exists(fmap_file_ap) and os.path.exists(fmap_file_pa):
-            add_intended_for(
-                fmap_files_dir + '/' + sub + '_' + ses + '_acq-fMRI_dir-AP_epi.json',
-                funcs
-                )
-            add_intended_for(
-                fmap_files_dir + '/' + sub + '_' + ses + '_acq-fMRI_dir-PA_epi.json',
-                funcs
-                )
-        # get list of all dwi files for each subject and session
-        dwis = get_dwi_list(DWI_LIST_FILE, sub, ses)
-        # if fieldmap files exist, add "IntendedFor" key-value pair to each dwi json file
-        fmap_file_ap = fmap_files_dir + '/' + sub + '_' + ses + '_acq-dwi_dir-AP_epi.json'
-        fmap_file_pa = fmap_files_dir + '/' + sub + '_' + ses + '_acq-dwi_dir-PA_epi.json'
-        if os.path.exists(fmap_file_ap) and os.path.exists(fmap_file_pa):
-            add_intended_for(
-                fmap_files_dir + '/' + sub + '_' + ses + '_acq-dwi_dir-AP_epi.json',
-                dwis
-                )
-            add_intended_for(
-                fmap_files_dir + '/' + sub + '_' + ses + '_acq-dwi_dir-PA_epi.json',
-                dwis
+def add_intended_for_pair(ap_file: str, pa_file: str, funcs: list[str]) -> None:
+    """
+    Adds the same "IntendedFor" array to an AP/PA pair of fieldmap
+    JSON files.
+
+    The two pepolar fieldmaps of a pair always target the same scans,
+    so the caller computes funcs once and the same list is applied to
+    both files rather than being rebuilt per file.
+
+    Args:
+    - ap_file (str): the file path of the dir-AP fieldmap JSON file
+    - pa_file (str): the file path of the dir-PA fieldmap JSON file
+    - funcs (List[str]): a list of file names in the format
+      ses_id/file for the same subject and session
+
+    Returns:
+    - None
+    """
+    # encode the shared payload once for both files of the pair
+    intended_bytes = _dumps(funcs)
+    for json_file in (ap_file, pa_file):
+        add_intended_for(json_file, funcs, intended_bytes)
+
+def iter_sessions(source_path: str):
+    """
+    Yields (sub_id, ses_id) pairs for every session directory under
+    source_path.
+
+    Uses os.scandir for the descent so is_dir() can read the entry
+    type returned by the directory scan instead of issuing an extra
+    stat() per entry. Symlinked entries are not followed.
+
+    Args:
+    - source_path (str): the path to the source directory containing
+      subject and session data
+
+    Yields:
+    - (sub_id, ses_id) (Tuple[str, str]): one pair per session directory
+    """
+    for sub_entry in os.scandir(source_path):
+        if not sub_entry.is_dir(follow_symlinks=False):
+            continue
+        for ses_entry in os.scandir(sub_entry.path):
+            if not ses_entry.is_dir(follow_symlinks=False):
+                continue
+            yield sub_entry.name, ses_entry.name
+
+def process_session(sub: str, ses: str,
+                    func_index: dict[tuple[str, str], list[str]],
+                    dwi_index: dict[tuple[str, str], list[str]]) -> None:
+    """
+    Adds the "IntendedFor" key-value pair to the fmap JSON files of a
+    single subject and session.
+
+    Each session touches a disjoint set of JSON files, so sessions can
+    be processed concurrently.
+
+    Args:
+    - sub (str): the subject ID, e.g. sub-XXX
+    - ses (str): the session ID, e.g. ses-YYY
+    - func_index (Dict[Tuple[str, str], List[str]]): functional file names
+      keyed by (sub_id, ses_id), as returned by build_index
+    - dwi_index (Dict[Tuple[str, str], List[str]]): DWI file names
+      keyed by (sub_id, ses_id), as returned by build_index
+
+    Returns:
+    - None
+    """
+    # get the func and dwi files for the subject and session
+    funcs = func_index.get((sub, ses), [])
+    dwis = dwi_index.get((sub, ses), [])
+    # list the fmap directory once and test membership in the set,
+    # instead of a stat() call per candidate fmap json file
+    fmap_files_dir = f'{SOURCE_PATH}/{sub}/{ses}/fmap'
+    try:
+        fmap_entries = {entry.name for entry in os.scandir(fmap_files_dir)}
+    except (FileNotFoundError, NotADirectoryError):
+        # sessions without an fmap directory, or with fmap as a
+        # non-directory entry, have nothing to update
+        return
+    # build the shared filename prefix once instead of re-concatenating
+    # it for every candidate fmap json file
+    prefix = f'{sub}_{ses}_'
+    # if both fieldmap files of a pair exist, add the "IntendedFor"
+    # key-value pair to each of its json files
+    for pair, intended in ((FMRI_PAIR, funcs), (DWI_PAIR, dwis)):
+        fmap_file_ap, fmap_file_pa = (prefix + suffix for suffix in pair)
+        if fmap_file_ap in fmap_entries and fmap_file_pa in fmap_entries:
+            add_intended_for_pair(
+                f'{fmap_files_dir}/{fmap_file_ap}',
+                f'{fmap_files_dir}/{fmap_file_pa}',
+                intended
                 )
+
+# perform for all subjects and sessions
+if __name__ == '__main__':
+    # index the func and dwi lists once, keyed by (sub, ses); cached
+    # sidecar indexes are reused when the lists have not changed
+    func_index = load_index(FUNC_LIST_FILE)
+    dwi_index = load_index(DWI_LIST_FILE)
+    # the work is I/O-bound JSON reads/writes on separate files,
+    # so overlap the filesystem latency with a thread pool
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+        list(executor.map(
+            lambda task: process_session(*task, func_index, dwi_index),
+            iter_sessions(SOURCE_PATH)
+            ))